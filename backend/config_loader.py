@@ -0,0 +1,53 @@
+# Description: This module loads the YAML configuration files used by the server, the collectors and the uploader.
+# Parsed configs are cached per file path and reused for as long as the file's modification time and size are unchanged.
+# A deep copy is returned on every call so callers can modify their config without corrupting the cached entry.
+
+import os
+import copy
+from collections import OrderedDict
+from typing import Any
+import yaml
+
+# Use the LibYAML based loader when PyYAML was built with it, it is much faster than the pure Python one
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader  # type: ignore[assignment]
+
+# Maximum number of parsed config files kept in the cache
+_YAML_CACHE_SIZE = 100
+
+# Absolute path -> (mtime, size, parsed config)
+_YAML_CACHE: OrderedDict[str, tuple[float, int, Any]] = OrderedDict()
+
+def load_yaml_cached(config_path: str) -> Any:
+    """
+    Load a YAML file, reusing the cached parse while the file is unchanged
+
+    Args:
+    config_path (str): Path to the YAML file
+
+    Returns:
+    dict: The parsed YAML document
+    """
+    path = os.path.abspath(config_path)
+    stat = os.stat(path)
+
+    # Return a copy of the cached config if the file hasn't changed
+    entry = _YAML_CACHE.get(path)
+    if entry and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+        _YAML_CACHE.move_to_end(path)
+        return copy.deepcopy(entry[2])
+
+    # Open in binary mode so LibYAML reads the bytes directly without Python decoding them first
+    with open(path, 'rb') as file:
+        config = yaml.load(file, Loader=_Loader)
+
+    _YAML_CACHE[path] = (stat.st_mtime, stat.st_size, config)
+    _YAML_CACHE.move_to_end(path)
+
+    # Evict the least recently used entry once the cache is full
+    if len(_YAML_CACHE) > _YAML_CACHE_SIZE:
+        _YAML_CACHE.popitem(last=False)
+
+    return copy.deepcopy(config)
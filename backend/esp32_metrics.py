@@ -1,120 +1,225 @@
 # description: This script listens for UDP packets from an ESP32 device and saves the temperature readings to a file in a queue directory.
-# The script is designed to run continuously and save the metrics to a file each time a packet is received.
-# The metrics are saved in JSON format with the device name, temperature reading, and timestamp.
+# The script is designed to run continuously and append the metrics to an hourly segment file each time a packet is received.
+# The metrics are saved as JSON lines with the device name, temperature reading, and timestamp.
 # The script also logs the received messages and any errors that occur during processing.
 # The script can be run as a standalone program and will listen for packets on the specified host and port.
-# The queue directory is created if it does not exist, and the metrics are saved to a file with a unique filename based on the timestamp.
+# The queue directory is created if it does not exist, and the metrics are appended to a file named after the current hour.
 # The script can be stopped by pressing Ctrl+C, which will close the UDP socket and exit the program.
 
 #define imports
 import os
+import sys
 import socket
+import selectors
 import time
 import re
-import json
+import orjson
 import logging
+from config_loader import load_yaml_cached
+from log_handlers import BatchedMemoryHandler, start_queue_logging
+from queue_files import ensure_dir, hour_bounds, segment_path
+from typing import BinaryIO, Optional
+
+# Skip collecting thread and process details for log records, they are never formatted
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
+# Precompiled pattern applied to the raw packet bytes, leading whitespace is skipped
+_TEMP_RE = re.compile(rb'\s*Temperature: (\d+\.\d+) C')
+
+# Requested UDP receive buffer size, large enough to absorb bursts of packets
+RCVBUF_SIZE = 12 * 1024 * 1024  # 12MB
+
+# Linux socket option for NAPI busy polling, not exposed by the socket module
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)
 
 class ESP32MetricsCollector:
 
-    def __init__(self, host="192.168.42.61", port=12345, queue_dir='metrics_queue'): #change ip as required
+    def __init__(self, host: str = "192.168.42.61", port: int = 12345, queue_dir: str = 'metrics_queue', busy_poll_usec: int = 0) -> None: #change ip as required
         # Configure UDP socket
-        self.host = host
-        self.port = port
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.host: str = host
+        self.port: int = port
+        self.sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind((self.host, self.port))
         
         # Setup logging
-        self.logger = self._setup_logging()
+        self.logger: logging.Logger = self._setup_logging()
+
+        # Enlarge the receive buffer so bursts aren't dropped by the kernel
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+        rcvbuf = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        # Linux doubles the requested size to leave room for bookkeeping and reports the doubled value
+        granted = rcvbuf // 2 if sys.platform.startswith('linux') else rcvbuf
+        if granted < RCVBUF_SIZE:
+            self.logger.warning("UDP receive buffer limited to %s bytes, raise net.core.rmem_max to allow %s", granted, RCVBUF_SIZE)
+
+        # Optionally busy poll the device queue to cut receive latency, at the cost of CPU
+        if busy_poll_usec and sys.platform.startswith('linux'):
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, busy_poll_usec)
+            except OSError as e:
+                self.logger.warning("Could not enable busy polling: %s", e)
         
         # Create queue directory
-        self.queue_dir = queue_dir
-        os.makedirs(self.queue_dir, exist_ok=True)
+        self.queue_dir: str = queue_dir
+        ensure_dir(self.queue_dir)
+
+        # Receive buffer reused for every packet, so receiving doesn't allocate
+        self._rx_buf: bytearray = bytearray(2048)
 
-    def _setup_logging(self):
+        # Hourly segment file kept open across packets
+        self._segment: Optional[BinaryIO] = None
+        # Time the open segment's hour ends, so the hour is only formatted when rolling over
+        self._segment_end: int = 0
+        # Segment paths are this prefix followed by the hour
+        self._segment_prefix: str = os.path.join(self.queue_dir, 'esp32_metrics_')
+
+    def _setup_logging(self) -> logging.Logger:
         # Create logs directory
         log_dir = 'logs'
-        os.makedirs(log_dir, exist_ok=True)
+        ensure_dir(log_dir)
 
         # Create logger
         logger = logging.getLogger('esp32_metrics')
+        # Already configured, adding handlers again would log every record twice
+        if logger.handlers:
+            return logger
         logger.setLevel(logging.INFO)
 
+        # Handlers are run by the queue listener rather than attached to the logger
+        handlers: list[logging.Handler] = []
+
         # Console handler
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-        logger.addHandler(console_handler)
+        handlers.append(console_handler)
 
         # File handler 
         file_handler = logging.FileHandler(os.path.join(log_dir, 'esp32_metrics.log'))
         file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-        logger.addHandler(file_handler)
+        # Write the file in batches of up to 100 records, errors are written straight away
+        handlers.append(BatchedMemoryHandler(100, logging.ERROR, file_handler))
+
+        # Hand records to a background thread so the caller never waits on log I/O
+        start_queue_logging(logger, handlers)
 
         return logger
 
-    def save_metrics(self, temperature):
+    def _open_segment(self, timestamp: int) -> BinaryIO:
         """
-        Save metrics to a file in the queue directory
+        Open the hourly segment file that metrics are appended to
+        
+        Args:
+        timestamp (int): Time within the hour the segment covers
+        
+        Returns:
+        BinaryIO: The opened segment file
+        """
+        if self._segment:
+            self._segment.close()
+            # Forget the closed file, so a failed open below is retried on the next reading
+            self._segment = None
+
+        hour, segment_end = hour_bounds(timestamp)
+        filename = segment_path(self._segment_prefix, hour)
+        self._segment = open(filename, 'ab', buffering=0)  # Unbuffered, one write per record
+        # Only move the rollover time once the new segment is open
+        self._segment_end = segment_end
+        return self._segment
+
+    def save_metrics(self, temperature: float) -> None:
+        """
+        Append metrics to the current hourly segment in the queue directory
         
         Args:
         temperature (float): Temperature reading
         """
         try:
+            # Read the clock once, as integer seconds, for both the payload and the segment
+            timestamp: int = time.time_ns() // 1_000_000_000
+            
             # Create metrics payload
             metrics = {
                 'device_name': 'esp32_device',
                 'temperature': temperature,
-                'timestamp': int(time.time())
+                'timestamp': timestamp
             }
             
-            # Create a unique filename with timestamp
-            filename = os.path.join(
-                self.queue_dir, 
-                f"esp32_metrics_{int(time.time())}.json"
-            )
+            # Roll over to a new segment when the hour changes
+            segment = self._segment
+            if segment is None or timestamp >= self._segment_end:
+                segment = self._open_segment(timestamp)
             
-            # Write metrics to file
-            with open(filename, 'w') as f:
-                json.dump(metrics, f)
+            # Append metrics as a single JSON line
+            segment.write(orjson.dumps(metrics, option=orjson.OPT_APPEND_NEWLINE))
             
-            self.logger.info(f"Saved metrics to {filename}")
+            self.logger.info("Saved metrics to %s", segment.name)
         except Exception as e:
-            self.logger.error(f"Error saving metrics: {e}")
+            self.logger.error("Error saving metrics: %s", e)
+
+    def _handle_packet(self, nbytes: int, addr: tuple[str, int]) -> None:
+        """
+        Parse a packet from the receive buffer and save the temperature reading
+        
+        Args:
+        nbytes (int): Size of the packet at the start of the receive buffer
+        addr (tuple): Address of the sender
+        """
+        try:
+            # Use regex to extract temperature straight from the receive buffer, no copy or decode needed
+            match = _TEMP_RE.match(self._rx_buf, 0, nbytes)
+            if match:
+                temperature: float = float(match.group(1))
+                
+                # Save metrics to queue
+                self.save_metrics(temperature)
+                
+                # Only decode the message if it will actually be logged
+                if self.logger.isEnabledFor(logging.INFO):
+                    message = self._rx_buf[:nbytes].decode('utf-8', errors='replace').strip()
+                    self.logger.info("Received from %s: %s", addr, message)
+            else:
+                message = self._rx_buf[:nbytes].decode('utf-8', errors='replace').strip()
+                self.logger.warning("Unrecognized message format: %s", message)
+        except (ValueError, TypeError) as e:
+            self.logger.error("Error processing received data: %s", e)
 
-    def run(self):
+    def run(self) -> None:
         """
         Main method to run metrics collection
         """
-        self.logger.info(f"Listening on {self.host}:{self.port}")
+        self.logger.info("Listening on %s:%s", self.host, self.port)
+
+        # Wait for the socket to become readable, then drain every queued packet
+        self.sock.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
 
         try:
             while True:
-                data, addr = self.sock.recvfrom(1024)  # Buffer size is 1024 bytes
-                try:
-                    # Parse received data
-                    message = data.decode('utf-8').strip()
-
-                    # Use regex to extract temperature
-                    match = re.match(r'Temperature: (\d+\.\d+) C', message)
-                    if match:
-                        temperature = float(match.group(1))
-                        
-                        # Save metrics to queue
-                        self.save_metrics(temperature)
-                        
-                        self.logger.info(f"Received from {addr}: {message}")
-                    else:
-                        self.logger.warning(f"Unrecognized message format: {message}")
-                except (ValueError, TypeError) as e:
-                    self.logger.error(f"Error processing received data: {e}")
+                selector.select()
+                while True:
+                    try:
+                        nbytes, addr = self.sock.recvfrom_into(self._rx_buf)
+                    except BlockingIOError:
+                        break
+                    self._handle_packet(nbytes, addr)
         # Handle keyboard interrupt            
         except KeyboardInterrupt:
             self.logger.info("Exiting...")
         finally:
+            selector.close()
             self.sock.close()
+            if self._segment:
+                self._segment.close()
 
-def main():
+def main() -> None:
+    # Busy polling is set in the client configuration, and stays off when it isn't
+    client_config = load_yaml_cached('config.yaml')['client']
+    busy_poll_usec = int(client_config.get('esp32_busy_poll_usec', 0))
     # Create an instance of the ESP32MetricsCollector class
-    collector = ESP32MetricsCollector()
+    collector = ESP32MetricsCollector(busy_poll_usec=busy_poll_usec)
     # Run the metrics collection process
     collector.run()
 
@@ -0,0 +1,12 @@
+# Description: Gunicorn settings for serving the Metrics server, loaded automatically when gunicorn is started from this directory.
+# One worker process per CPU core, each with a pool of threads so slow dashboard requests don't hold up metric POSTs.
+# Example: PORT=8000 gunicorn wsgi:app
+
+import os
+import multiprocessing
+
+# Listen on the port given by the hosting platform, WEB_CONCURRENCY overrides the worker count
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = 8
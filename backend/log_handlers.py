@@ -0,0 +1,61 @@
+# Description: This module provides the logging setup shared by the server, the collectors and the uploader.
+# BatchedMemoryHandler holds log records in memory and writes them to a log file in batches.
+# Each batch is formatted into one string and written with a single write call, rather than one write per record.
+# The buffer is written out when it is full, when a record at the flush level arrives, and when logging shuts down.
+# start_queue_logging runs a logger's handlers on a background thread, so logging never blocks on I/O.
+
+import atexit
+import queue
+import logging
+from logging.handlers import MemoryHandler, RotatingFileHandler, QueueHandler, QueueListener
+
+def start_queue_logging(logger: logging.Logger, handlers: list[logging.Handler]) -> None:
+    """
+    Hand a logger's records to a background thread that runs the handlers
+    
+    Args:
+    logger (logging.Logger): Logger to attach the queue to
+    handlers (list): Handlers run by the listener thread rather than attached to the logger
+    """
+    log_queue: queue.Queue[logging.LogRecord] = queue.Queue(-1)
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Flush queued records on exit, this also keeps the listener referenced
+    atexit.register(listener.stop)
+
+class BatchedMemoryHandler(MemoryHandler):
+    def __init__(self, capacity: int, flushLevel: int, target: logging.FileHandler) -> None:
+        super().__init__(capacity, flushLevel=flushLevel, target=target)
+        # Records the file would filter out are never buffered
+        self.setLevel(target.level)
+
+    def flush(self) -> None:
+        """
+        Write every buffered record to the target file with a single write
+        """
+        self.acquire()
+        try:
+            target = self.target
+            if not isinstance(target, logging.FileHandler) or not self.buffer:
+                return
+
+            data = ''.join(target.format(record) + target.terminator for record in self.buffer)
+            target.acquire()
+            try:
+                # Opened on first use, the same way FileHandler.emit does it
+                if target.stream is None:
+                    target.stream = target._open()
+                # Rotate first when the batch would take a rotating log past its size limit
+                if isinstance(target, RotatingFileHandler) and target.maxBytes > 0 \
+                        and target.stream.tell() + len(data) >= target.maxBytes:
+                    target.doRollover()
+                target.stream.write(data)
+                target.stream.flush()
+            except Exception:
+                target.handleError(self.buffer[-1])
+            finally:
+                target.release()
+            self.buffer.clear()
+        finally:
+            self.release()
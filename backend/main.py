@@ -5,12 +5,32 @@
 
 # Import required libraries
 import os
+import io
+import zlib
+import time
+import atexit
+import queue
+import threading
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, which only runs the single process development server
+    fcntl = None
+from typing import Optional
 import logging
 from logging.handlers import RotatingFileHandler
-import yaml
+from config_loader import load_yaml_cached
+from log_handlers import BatchedMemoryHandler, start_queue_logging
+import orjson
+from pydantic import BaseModel, ValidationError
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
+from werkzeug.wrappers import Response
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String, Float, DateTime
+from flask_caching import Cache
+from sqlalchemy import Column, Integer, String, Float, Index, event, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import load_only, raiseload
 from sqlalchemy.sql import func
 import dash
 from dash import dcc, html
@@ -19,8 +39,7 @@ import plotly.graph_objs as go
 
 # Load configuration from a YAML file
 def load_config(config_path='config.yaml'):
-    with open(config_path, 'r') as file:
-        return yaml.safe_load(file)
+    return load_yaml_cached(config_path)
 
 # Configure logging
 def setup_logging(config):
@@ -29,12 +48,17 @@ def setup_logging(config):
     os.makedirs(log_dir, exist_ok=True)
     # Create logger
     logger = logging.getLogger('performance_tracker')
+    # Already configured, adding handlers again would log every record twice
+    if logger.handlers:
+        return logger
     logger.setLevel(getattr(logging, config['logging']['level'].upper()))
+    # Handlers are run by the queue listener rather than attached to the logger
+    handlers = []
     # Console handler
     if config['logging']['console']['enabled']:
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-        logger.addHandler(console_handler)
+        handlers.append(console_handler)
     # File handler
     if config['logging']['file']['enabled']:
         file_handler = RotatingFileHandler(
@@ -43,18 +67,77 @@ def setup_logging(config):
             backupCount=5
         )
         file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-        logger.addHandler(file_handler)
+        # Debug records never reach the disk
+        file_handler.setLevel(logging.INFO)
+        # Write the file in batches of up to 100 records, errors are written straight away
+        handlers.append(BatchedMemoryHandler(100, logging.ERROR, file_handler))
+
+    # Hand records to a background thread so the caller never waits on log I/O
+    start_queue_logging(logger, handlers)
 
     return logger
 
+# JSON provider backed by orjson, used by jsonify and request.get_json
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        # orjson returns bytes, decode to the str Flask expects
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Build the body straight from the bytes rather than going through a str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+# Largest request body accepted once decompressed
+MAX_DECOMPRESSED_BYTES = 16 * 1024 * 1024
+
+# WSGI middleware that decompresses gzip encoded request bodies before Flask reads them
+class GzipRequestMiddleware:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if environ.get('HTTP_CONTENT_ENCODING', '').lower() == 'gzip':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)  # Expect a gzip header
+            try:
+                body = decompressor.decompress(environ['wsgi.input'].read(length), MAX_DECOMPRESSED_BYTES)
+            except zlib.error:
+                return self._error('Invalid gzip body', 400, environ, start_response)
+            # Anything left over means the body decompresses past the limit
+            if decompressor.unconsumed_tail:
+                return self._error('Request body too large', 413, environ, start_response)
+
+            # Hand the decompressed body on as if it had been sent uncompressed
+            environ['wsgi.input'] = io.BytesIO(body)
+            environ['CONTENT_LENGTH'] = str(len(body))
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.wsgi_app(environ, start_response)
+
+    def _error(self, message, status, environ, start_response):
+        response = Response(orjson.dumps({'status': 'error', 'message': message}), status=status, mimetype='application/json')
+        return response(environ, start_response)
+
 # Load config
 config = load_config()
 
 # Setup Flask and SQLAlchemy
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Uploaders gzip their larger batches
+app.wsgi_app = GzipRequestMiddleware(app.wsgi_app)
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{config['database']['path']}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+# Keep a bounded, warm pool of connections shared by the server threads
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 20, 'max_overflow': 0, 'pool_pre_ping': True}
+# Don't flush pending objects before every query, views commit explicitly
+db = SQLAlchemy(app, session_options={'autoflush': False})
+
+# In-process cache for dashboard queries
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 5})
 
 # Setup logging
 logger = setup_logging(config)
@@ -62,27 +145,36 @@ logger = setup_logging(config)
 #ORM model for esp32 temperature metrics
 class ESP32TemperatureSnapshot(db.Model):
     __tablename__ = 'esp32_temperature_snapshot'
+    # Index for the latest-first and history queries per device
+    __table_args__ = (
+        Index('ix_esp32_device_ts', 'device_name', 'timestamp'),
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     device_name = Column(String(255), nullable=False)
-    timestamp = Column(DateTime, default=func.now())
+    timestamp = Column(Integer, default=lambda: int(time.time()))  # Unix epoch seconds, UTC
     temperature = Column(Float, nullable=False)
 
     def to_dict(self):
         return {
             'id': self.id,
             'device_name': self.device_name,
-            'timestamp': self.timestamp.isoformat(),
+            'timestamp': self.timestamp,
             'temperature': self.temperature,
         }
     
 # ORM Model for Device Performance
 class DevicePerformanceSnapshot(db.Model):
     __tablename__ = 'device_performance_snapshot'
+    # Indexes for the latest-first queries, with and without a device filter
+    __table_args__ = (
+        Index('ix_dps_device_ts', 'device_name', 'timestamp'),
+        Index('ix_dps_ts', 'timestamp'),
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     device_name = Column(String(255), nullable=False)
-    timestamp = Column(DateTime, default=func.now())
+    timestamp = Column(Integer, default=lambda: int(time.time()))  # Unix epoch seconds, UTC
     num_threads = Column(Integer, nullable=False)
     num_processes = Column(Integer, nullable=False)
     ram_usage_mb = Column(Float, nullable=False)
@@ -91,44 +183,241 @@ class DevicePerformanceSnapshot(db.Model):
         return {
             'id': self.id,
             'device_name': self.device_name,
-            'timestamp': self.timestamp.isoformat(),
+            'timestamp': self.timestamp,
             'num_threads': self.num_threads,
             'num_processes': self.num_processes,
             'ram_usage_mb': self.ram_usage_mb
         }
 
-# Ensure database and tables are created
-with app.app_context():
+# Column holding each metric shown on the dashboard
+METRIC_COLUMNS = {
+    'ram_usage_mb': DevicePerformanceSnapshot.ram_usage_mb,
+    'num_threads': DevicePerformanceSnapshot.num_threads,
+    'num_processes': DevicePerformanceSnapshot.num_processes,
+    'temperature': ESP32TemperatureSnapshot.temperature,
+}
+
+# Fields returned by the GET endpoints, in response order
+METRICS_KEYS = ('id', 'device_name', 'timestamp', 'num_threads', 'num_processes', 'ram_usage_mb')
+ESP32_METRICS_KEYS = ('id', 'device_name', 'timestamp', 'temperature')
+
+# Tune SQLite for write throughput, WAL also lets the dashboard read while metrics are written
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+# Schemas for incoming device performance metrics, validated by pydantic's compiled core
+class MetricsIn(BaseModel):
+    device_name: str
+    num_threads: int
+    num_processes: int
+    ram_usage_mb: float
+    # Unix epoch seconds the client recorded the snapshot at, the arrival time when left out
+    timestamp: Optional[int] = None
+
+class MetricsBatchIn(BaseModel):
+    snapshots: list[MetricsIn]
+
+class ESP32MetricsIn(BaseModel):
+    device_name: str = 'ESP32'
+    temperature: float
+    # Unix epoch seconds the client recorded the snapshot at, the arrival time when left out
+    timestamp: Optional[int] = None
+
+class ESP32MetricsBatchIn(BaseModel):
+    snapshots: list[ESP32MetricsIn]
+
+def validation_error_message(error):
+    # Describe the first validation error in the same format as the original field checks
+    first_error = error.errors()[0]
+    # An empty location means the body itself is the wrong type, e.g. a list instead of an object
+    if not first_error['loc']:
+        return 'Request body must be a JSON object'
+    field = '.'.join(str(part) for part in first_error['loc'])
+    if first_error['type'] == 'missing':
+        return f'Missing required field: {field}'
+    return f'Invalid value for field: {field}'
+
+def parse_payload(model):
+    # Parse and validate the request body against a pydantic model, returning the payload or the 400
+    # response to send back instead. Bodies that aren't JSON, or fail to parse, get a 400 rather than an exception
+    data = request.get_json(silent=True)
+    if data is None:
+        logger.warning('Invalid JSON body')
+        return None, (jsonify({'status': 'error', 'message': 'Invalid JSON'}), 400)
+    try:
+        return model.model_validate(data), None
+    except ValidationError as e:
+        message = validation_error_message(e)
+        logger.warning(message)
+        return None, (jsonify({'status': 'error', 'message': message}), 400)
+
+# Version of the data stored in the database, raised whenever a migration is added below
+SCHEMA_VERSION = 1
+
+# Ensure database and tables are created. Every gunicorn worker imports this module, so the workers
+# take turns holding a file lock and only the first one has anything to create
+os.makedirs(app.instance_path, exist_ok=True)
+with app.app_context(), open(os.path.join(app.instance_path, '.schema.lock'), 'w') as schema_lock:
+    if fcntl:
+        fcntl.flock(schema_lock, fcntl.LOCK_EX)
+    event.listen(db.engine, 'connect', set_sqlite_pragmas)
     db.create_all()
+    # create_all skips existing tables, so add any indexes missing from an older database
+    for model in (DevicePerformanceSnapshot, ESP32TemperatureSnapshot):
+        for index in model.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+    # Older databases stored timestamps as UTC datetime text, convert those rows to epoch seconds.
+    # The scan covers every row, so the database's user_version records that it has been done
+    with db.engine.begin() as connection:
+        if connection.execute(text('PRAGMA user_version')).scalar() < SCHEMA_VERSION:
+            for model in (DevicePerformanceSnapshot, ESP32TemperatureSnapshot):
+                connection.execute(text(
+                    f"UPDATE {model.__tablename__} SET timestamp = CAST(strftime('%s', timestamp) AS INTEGER) "
+                    "WHERE typeof(timestamp) = 'text'"
+                ))
+            connection.execute(text(f'PRAGMA user_version = {SCHEMA_VERSION}'))
+
+# Snapshots waiting to be written, as (model, row) pairs
+snapshot_queue = queue.Queue()
+# Flush once this many snapshots are waiting, or after the interval, whichever comes first
+SNAPSHOT_BATCH_SIZE = 100
+SNAPSHOT_FLUSH_INTERVAL = 0.5  # seconds
+# Commits retried when the database is busy or locked, waiting longer after each failure
+SNAPSHOT_WRITE_ATTEMPTS = 3
+SNAPSHOT_RETRY_DELAY = 0.5  # seconds
+
+def snapshot_row(snapshot, arrival_time):
+    # Keep the time the client recorded the snapshot, stamping it with its arrival time when it has none
+    row = snapshot.model_dump()
+    if row['timestamp'] is None:
+        row['timestamp'] = arrival_time
+    return row
+
+def enqueue_snapshot(model, snapshot):
+    # Stamp the snapshot now, it is written to the database later
+    snapshot_queue.put((model, snapshot_row(snapshot, int(time.time()))))
+
+def write_snapshots(batch):
+    # Insert a batch of queued snapshots with a single commit. Returns False when the database
+    # stayed unavailable and the batch should be queued again
+    rows_by_model = {}
+    for model, row in batch:
+        rows_by_model.setdefault(model, []).append(row)
+    with app.app_context():
+        for attempt in range(SNAPSHOT_WRITE_ATTEMPTS):
+            try:
+                for model, rows in rows_by_model.items():
+                    db.session.bulk_insert_mappings(model, rows)
+                db.session.commit()
+                break
+            except OperationalError as e:
+                # The database is locked or unreachable, which usually clears up after a moment
+                db.session.rollback()
+                logger.warning('Error writing %d queued snapshots (attempt %d of %d): %s',
+                               len(batch), attempt + 1, SNAPSHOT_WRITE_ATTEMPTS, e)
+                # No wait after the last attempt, shutdown only gives the writer a few seconds
+                if attempt + 1 < SNAPSHOT_WRITE_ATTEMPTS:
+                    time.sleep(SNAPSHOT_RETRY_DELAY * 2 ** attempt)
+            except Exception as e:
+                # Anything else would fail the same way again, so the batch is dropped
+                db.session.rollback()
+                logger.error('Error writing %d queued snapshots: %s', len(batch), e)
+                return True
+        else:
+            return False
+        refresh_device_names(set(row['device_name'] for _, row in batch))
+        logger.info('Wrote %d queued snapshots', len(batch))
+        return True
+
+def snapshot_writer():
+    # Background thread that turns one commit per request into one commit per batch
+    while True:
+        # Block until something arrives, then gather more until the batch is full or the interval is up
+        batch = [snapshot_queue.get()]
+        deadline = time.monotonic() + SNAPSHOT_FLUSH_INTERVAL
+        while len(batch) < SNAPSHOT_BATCH_SIZE and None not in batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(snapshot_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # None is the shutdown signal
+        stopping = None in batch
+        batch = [item for item in batch if item is not None]
+        if stopping:
+            # A batch requeued while the signal was sent sits behind it, so take everything left
+            while True:
+                try:
+                    item = snapshot_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    batch.append(item)
+        if batch and not write_snapshots(batch):
+            if stopping:
+                logger.error('Database unavailable, %d queued snapshots were not written', len(batch))
+            else:
+                # Put the batch back so it is written once the database recovers
+                for item in batch:
+                    snapshot_queue.put(item)
+        if stopping:
+            return
+
+def stop_snapshot_writer():
+    # Write out anything still queued before the process exits
+    snapshot_queue.put(None)
+    snapshot_writer_thread.join(timeout=5)
+
+snapshot_writer_thread = threading.Thread(target=snapshot_writer, name='snapshot-writer', daemon=True)
+snapshot_writer_thread.start()
+atexit.register(stop_snapshot_writer)
 
 # Flask endpoints
 @app.route('/metrics', methods=['POST'])
 def receive_metrics():
     try:
-        #validate incoming data
-        data = request.get_json()
-        # Check for required fields
-        required_fields = ['device_name', 'num_threads', 'num_processes', 'ram_usage_mb']
-        for field in required_fields:
-            if field not in data:
-                logger.warning(f'Missing required field: {field}')
-                return jsonify({'status': 'error', 'message': f'Missing required field: {field}'}), 400
-        # Create a new snapshot
-        new_snapshot = DevicePerformanceSnapshot(
-            device_name=data['device_name'],
-            num_threads=data['num_threads'],
-            num_processes=data['num_processes'],
-            ram_usage_mb=data['ram_usage_mb']
-        )
-        db.session.add(new_snapshot)
+        # Validate incoming data
+        payload, error_response = parse_payload(MetricsIn)
+        if error_response:
+            return error_response
+        # Queue the snapshot for the background writer
+        enqueue_snapshot(DevicePerformanceSnapshot, payload)
+        logger.info('Metrics queued for device: %s', payload.device_name)
+        # Accepted for writing, no body needed
+        return '', 202
+    
+    except Exception as e:
+        logger.error('Error receiving metrics: %s', e)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# endpoint for a batch of metrics, inserted in a single transaction
+@app.route('/metrics/batch', methods=['POST'])
+def receive_metrics_batch():
+    try:
+        # Validate incoming data
+        batch, error_response = parse_payload(MetricsBatchIn)
+        if error_response:
+            return error_response
+        arrival_time = int(time.time())
+        rows = [snapshot_row(snapshot, arrival_time) for snapshot in batch.snapshots]
+        # Insert all snapshots with one statement and one commit
+        db.session.bulk_insert_mappings(DevicePerformanceSnapshot, rows)
         db.session.commit()
-        logger.info(f'Metrics recorded for device: {data["device_name"]}')
-        return jsonify({'status': 'success', 'message': 'Metrics recorded', 'snapshot': new_snapshot.to_dict()}), 201
+        refresh_device_names([row['device_name'] for row in rows])
+        logger.info('Batch of %d metrics recorded', len(rows))
+        # No body on success, the uploader only needs the status code
+        return '', 204
     
     except Exception as e:
         # Rollback the session in case of an error
         db.session.rollback()
-        logger.error(f'Error receiving metrics: {str(e)}')
+        logger.error('Error receiving metrics batch: %s', e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 @app.route('/metrics', methods=['GET'])
@@ -137,24 +426,30 @@ def get_metrics():
         #optional query parameters to filter and limit the results
         device_name = request.args.get('device_name')
         limit = request.args.get('limit', default=100, type=int)
+        # Select only the columns, skipping ORM object construction
+        query = DevicePerformanceSnapshot.query.with_entities(
+            *(getattr(DevicePerformanceSnapshot, key) for key in METRICS_KEYS)
+        )
         if device_name:
-            # Filter by device name, order by timestamp, and limit the results
-            snapshots = DevicePerformanceSnapshot.query \
-                .filter_by(device_name=device_name) \
-                .order_by(DevicePerformanceSnapshot.timestamp.desc()) \
+            # Filter by device name, order by timestamp with the newest insert first on ties, and limit the results
+            snapshots = query \
+                .filter(DevicePerformanceSnapshot.device_name == device_name) \
+                .order_by(DevicePerformanceSnapshot.timestamp.desc(), DevicePerformanceSnapshot.id.desc()) \
                 .limit(limit) \
                 .all()
         else:
-            snapshots = DevicePerformanceSnapshot.query \
-                .order_by(DevicePerformanceSnapshot.timestamp.desc()) \
+            snapshots = query \
+                .order_by(DevicePerformanceSnapshot.timestamp.desc(), DevicePerformanceSnapshot.id.desc()) \
                 .limit(limit) \
                 .all()
             
-        logger.info(f'Retrieved {len(snapshots)} metrics{" for device " + device_name if device_name else ""}')
-        return jsonify({'status': 'success', 'metrics': [snapshot.to_dict() for snapshot in snapshots]}), 200
+        # Pair each row's values with the fixed key order
+        metrics = [dict(zip(METRICS_KEYS, snapshot)) for snapshot in snapshots]
+        logger.info('Retrieved %d metrics%s', len(metrics), f' for device {device_name}' if device_name else '')
+        return jsonify({'status': 'success', 'metrics': metrics}), 200
     
     except Exception as e:
-        logger.error(f'Error retrieving metrics: {str(e)}')
+        logger.error('Error retrieving metrics: %s', e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 # endpoint for ESP32 metrics
@@ -162,32 +457,45 @@ def get_metrics():
 def receive_esp32_metrics():
     try:
         # Validate incoming data
-        data = request.get_json()
+        payload, error_response = parse_payload(ESP32MetricsIn)
+        if error_response:
+            return error_response
         
-        # Check for required fields
-        required_fields = ['temperature']
-        for field in required_fields:
-            if field not in data:
-                logger.warning(f'Missing required field: {field}')
-                return jsonify({'status': 'error', 'message': f'Missing required field: {field}'}), 400
+        # Queue the temperature snapshot for the background writer
+        enqueue_snapshot(ESP32TemperatureSnapshot, payload)
         
-        # Create a new temperature snapshot
-        new_snapshot = ESP32TemperatureSnapshot(
-            device_name = data.get('device_name', 'ESP32'),
-            temperature=data['temperature']
-        )
-        db.session.add(new_snapshot)
+        logger.info('Temperature metrics queued')
+        # Accepted for writing, no body needed
+        return '', 202
+    
+    except Exception as e:
+        logger.error('Error receiving ESP32 metrics: %s', e)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+    
+# endpoint for a batch of ESP32 metrics, inserted in a single transaction
+@app.route('/esp32metrics/batch', methods=['POST'])
+def receive_esp32_metrics_batch():
+    try:
+        # Validate incoming data
+        batch, error_response = parse_payload(ESP32MetricsBatchIn)
+        if error_response:
+            return error_response
+        arrival_time = int(time.time())
+        rows = [snapshot_row(snapshot, arrival_time) for snapshot in batch.snapshots]
+        # Insert all snapshots with one statement and one commit
+        db.session.bulk_insert_mappings(ESP32TemperatureSnapshot, rows)
         db.session.commit()
-        
-        logger.info(f'Temperature metrics recorded')
-        return jsonify({'status': 'success', 'message': 'Temperature metrics recorded', 'snapshot': new_snapshot.to_dict()}), 201
+        refresh_device_names([row['device_name'] for row in rows])
+        logger.info('Batch of %d temperature metrics recorded', len(rows))
+        # No body on success, the uploader only needs the status code
+        return '', 204
     
     except Exception as e:
         # Rollback the session in case of an error
         db.session.rollback()
-        logger.error(f'Error receiving ESP32 metrics: {str(e)}')
+        logger.error('Error receiving ESP32 metrics batch: %s', e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
-    
+
 # New endpoint to retrieve ESP32 metrics
 @app.route('/esp32metrics', methods=['GET'])
 def get_esp32_metrics():
@@ -196,25 +504,118 @@ def get_esp32_metrics():
         device_name = request.args.get('device_name')
         limit = request.args.get('limit', default=100, type=int)
         
+        # Select only the columns, skipping ORM object construction
+        query = ESP32TemperatureSnapshot.query.with_entities(
+            *(getattr(ESP32TemperatureSnapshot, key) for key in ESP32_METRICS_KEYS)
+        )
         if device_name:
-            snapshots = ESP32TemperatureSnapshot.query \
-                .filter_by(device_name=device_name) \
-                .order_by(ESP32TemperatureSnapshot.timestamp.desc()) \
+            snapshots = query \
+                .filter(ESP32TemperatureSnapshot.device_name == device_name) \
+                .order_by(ESP32TemperatureSnapshot.timestamp.desc(), ESP32TemperatureSnapshot.id.desc()) \
                 .limit(limit) \
                 .all()
         else:
-            snapshots = ESP32TemperatureSnapshot.query \
-                .order_by(ESP32TemperatureSnapshot.timestamp.desc()) \
+            snapshots = query \
+                .order_by(ESP32TemperatureSnapshot.timestamp.desc(), ESP32TemperatureSnapshot.id.desc()) \
                 .limit(limit) \
                 .all()
         
-        logger.info(f'Retrieved {len(snapshots)} ESP32 temperature metrics{" for device " + device_name if device_name else ""}')
-        return jsonify({'status': 'success', 'metrics': [snapshot.to_dict() for snapshot in snapshots]}), 200
+        metrics = [dict(zip(ESP32_METRICS_KEYS, snapshot)) for snapshot in snapshots]
+        logger.info('Retrieved %d ESP32 temperature metrics%s', len(metrics), f' for device {device_name}' if device_name else '')
+        return jsonify({'status': 'success', 'metrics': metrics}), 200
     
     except Exception as e:
-        logger.error(f'Error retrieving ESP32 metrics: {str(e)}')
+        logger.error('Error retrieving ESP32 metrics: %s', e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
     
+# Number of most recent snapshots shown in the metrics table
+TABLE_ROW_LIMIT = 200
+# Number of most recent points plotted in the line graph, more than a screen can show
+HISTORY_POINT_LIMIT = 10000
+# Number of points the line graph is downsampled to when there are more
+HISTORY_BUCKETS = 500
+
+# Dashboard queries, cached briefly since every interval tick and open dashboard repeats them
+@cache.memoize(timeout=30)
+def get_device_names():
+    # Combine device names from both performance and temperature snapshots, UNION removes duplicates in SQL
+    query = select(DevicePerformanceSnapshot.device_name).union(select(ESP32TemperatureSnapshot.device_name))
+    return [name for (name,) in db.session.execute(query)]
+
+def refresh_device_names(device_names):
+    # Drop the cached device names when a device reports in for the first time
+    known_devices = get_device_names()
+    if any(device_name not in known_devices for device_name in device_names):
+        cache.delete_memoized(get_device_names)
+
+def get_latest_value(device_name, selected_metric):
+    column = METRIC_COLUMNS.get(selected_metric)
+    if column is None:
+        return None
+    model = column.class_
+
+    # Load only the selected column, and fail loudly if anything later tries to lazy load
+    snapshot = model.query \
+        .options(load_only(column), raiseload('*')) \
+        .filter_by(device_name=device_name) \
+        .order_by(model.timestamp.desc(), model.id.desc()) \
+        .first()
+    if not snapshot:
+        return None
+    return getattr(snapshot, column.key)
+
+@cache.memoize()
+def get_table_rows():
+    # Fetch only the latest rows as plain tuples, rather than every snapshot as an ORM object
+    rows = db.session.execute(
+        select(
+            DevicePerformanceSnapshot.id,
+            DevicePerformanceSnapshot.device_name,
+            DevicePerformanceSnapshot.timestamp,
+            DevicePerformanceSnapshot.num_threads,
+            DevicePerformanceSnapshot.num_processes,
+            DevicePerformanceSnapshot.ram_usage_mb
+        )
+        .order_by(DevicePerformanceSnapshot.timestamp.desc(), DevicePerformanceSnapshot.id.desc())
+        .limit(TABLE_ROW_LIMIT)
+    ).all()
+    return [tuple(row) for row in rows]
+
+def get_metric_history(device_name, selected_metric):
+    column = METRIC_COLUMNS.get(selected_metric)
+    if column is None:
+        return (), ()
+    model = column.class_
+
+    # Just the timestamp and metric columns for the latest points
+    recent = select(model.timestamp.label('timestamp'), column.label('value')) \
+        .where(model.device_name == device_name) \
+        .order_by(model.timestamp.desc(), model.id.desc()) \
+        .limit(HISTORY_POINT_LIMIT) \
+        .subquery()
+
+    count, first, last = db.session.execute(
+        select(func.count(), func.min(recent.c.timestamp), func.max(recent.c.timestamp)).select_from(recent)
+    ).one()
+    if not count:
+        return (), ()
+
+    if count <= HISTORY_BUCKETS:
+        # Few enough to plot every point
+        query = select(recent.c.timestamp, recent.c.value).order_by(recent.c.timestamp)
+    else:
+        # Average the points into time buckets in SQL, sized so about HISTORY_BUCKETS come back
+        bucket_seconds = max(1, -(-(last - first + 1) // HISTORY_BUCKETS))
+        bucket_start = func.min(recent.c.timestamp)
+        query = select(bucket_start, func.avg(recent.c.value)) \
+            .group_by(recent.c.timestamp // bucket_seconds) \
+            .order_by(bucket_start)
+    rows = db.session.execute(query).all()
+
+    # Split into the x and y columns for plotting
+    timestamps, values = zip(*rows)
+    return timestamps, values
+
 # Integrate Dash with Flask
 dash_app = dash.Dash(__name__, server=app, url_base_pathname='/dashboard/')
 # Dash layout
@@ -272,20 +673,56 @@ dash_app.layout = html.Div([
         dcc.Graph(id='line-graph'),
     ])
 ])
+# Gauge ranges, colour bands and titles for each metric, built once at import
+METRIC_CONFIGS = {
+    'ram_usage_mb': {
+        'range': [0, 16000],
+        'steps': [
+            {'range': [0, 6000], 'color': "lightgreen"},
+            {'range': [6000, 10000], 'color': "yellow"},
+            {'range': [10000, 16000], 'color': "red"}
+        ],
+        'title': "RAM Usage (MB)"
+    },
+    'num_threads': {
+        'range': [0, 10000],
+        'steps': [
+            {'range': [0, 2500], 'color': "lightgreen"},
+            {'range': [2500, 5000], 'color': "yellow"},
+            {'range': [5000, 10000], 'color': "red"}
+        ],
+        'title': "Number of Threads"
+    },
+    'num_processes': {
+        'range': [0, 500],
+        'steps': [
+            {'range': [0, 200], 'color': "lightgreen"},
+            {'range': [200, 400], 'color': "yellow"},
+            {'range': [400, 500], 'color': "red"}
+        ],
+        'title': "Number of Processes"
+    },
+    'temperature': {
+        'range': [0, 45], 
+        'steps': [
+            {'range': [0, 15], 'color': "lightgreen"},
+            {'range': [15, 30], 'color': "yellow"},
+            {'range': [30, 45], 'color': "red"}
+        ],
+        'title': "Temperature (°C)"
+    }
+}
+
+# Figure shown when there is nothing to plot, kept as a plain dict like the cached figures
+EMPTY_FIGURE = go.Figure().to_plotly_json()
+
 # Callback to populate the dropdown with device names
 @dash_app.callback(
     Output('device-dropdown', 'options'),
     Input('interval-component', 'n_intervals')  # Periodically refresh device names
 )
 def update_device_dropdown(_):
-    # Combine device names from both performance and temperature snapshots
-    performance_devices = db.session.query(DevicePerformanceSnapshot.device_name).distinct().all()
-    temperature_devices = db.session.query(ESP32TemperatureSnapshot.device_name).distinct().all()
-    
-    # Combine and remove duplicates
-    all_devices = set(device[0] for device in performance_devices + temperature_devices)
-    
-    return [{'label': name, 'value': name} for name in all_devices]
+    return [{'label': name, 'value': name} for name in get_device_names()]
 
 # Callback to update the gauge chart
 @dash_app.callback(
@@ -296,68 +733,17 @@ def update_device_dropdown(_):
 # Update the gauge chart based on the selected device and metric
 def update_gauge(device_name, selected_metric):
     if not device_name or not selected_metric:
-        return go.Figure()
+        return EMPTY_FIGURE
+    return get_gauge_figure(device_name, selected_metric)
 
-    if selected_metric == 'temperature':
-        snapshot = ESP32TemperatureSnapshot.query \
-            .filter_by(device_name=device_name) \
-            .order_by(ESP32TemperatureSnapshot.timestamp.desc()) \
-            .first()
-    else:
-        snapshot = DevicePerformanceSnapshot.query \
-            .filter_by(device_name=device_name) \
-            .order_by(DevicePerformanceSnapshot.timestamp.desc()) \
-            .first()
-        
-    if not snapshot:
-            return go.Figure()
-
-    metric_configs = {
-        'ram_usage_mb': {
-            'range': [0, 16000],
-            'steps': [
-                {'range': [0, 6000], 'color': "lightgreen"},
-                {'range': [6000, 10000], 'color': "yellow"},
-                {'range': [10000, 16000], 'color': "red"}
-            ],
-            'title': "RAM Usage (MB)"
-        },
-        'num_threads': {
-            'range': [0, 10000],
-            'steps': [
-                {'range': [0, 2500], 'color': "lightgreen"},
-                {'range': [2500, 5000], 'color': "yellow"},
-                {'range': [5000, 10000], 'color': "red"}
-            ],
-            'title': "Number of Threads"
-        },
-        'num_processes': {
-            'range': [0, 500],
-            'steps': [
-                {'range': [0, 200], 'color': "lightgreen"},
-                {'range': [200, 400], 'color': "yellow"},
-                {'range': [400, 500], 'color': "red"}
-            ],
-            'title': "Number of Processes"
-        },
-        'temperature': {
-            'range': [0, 45], 
-            'steps': [
-                {'range': [0, 15], 'color': "lightgreen"},
-                {'range': [15, 30], 'color': "yellow"},
-                {'range': [30, 45], 'color': "red"}
-                ],
-                'title': "Temperature (°C)"
-            }
-        }
-
-    config = metric_configs.get(selected_metric, {})
+# Build the gauge figure, cached as a plain dict so repeat ticks skip Figure construction and validation
+@cache.memoize()
+def get_gauge_figure(device_name, selected_metric):
+    value = get_latest_value(device_name, selected_metric)
+    if value is None:
+        return EMPTY_FIGURE
 
-    # Get the value differently for temperature vs other metrics, as temperature is stored directly
-    if selected_metric == 'temperature':
-        value = snapshot.temperature
-    else:
-        value = getattr(snapshot, selected_metric)
+    config = METRIC_CONFIGS.get(selected_metric, {})
 
     figure = go.Figure(
         go.Indicator(
@@ -371,7 +757,7 @@ def update_gauge(device_name, selected_metric):
             }
         )
     )
-    return figure
+    return figure.to_plotly_json()
 
 
 # Callback to update the table dynamically
@@ -380,17 +766,19 @@ def update_gauge(device_name, selected_metric):
     Input('interval-component', 'n_intervals')
 )
 def update_table(_):
-    snapshots = DevicePerformanceSnapshot.query.order_by(DevicePerformanceSnapshot.timestamp.desc()).all()
-    if not snapshots:
+    rows = get_table_rows()
+    if not rows:
         return html.Div("No data available.")
 
+    # Transpose the rows into columns in one pass
+    ids, device_names, timestamps, num_threads, num_processes, ram_usage_mb = zip(*rows)
     table_data = {
-        "ID": [snapshot.id for snapshot in snapshots],
-        "Device Name": [snapshot.device_name for snapshot in snapshots],
-        "Timestamp": [snapshot.timestamp.strftime('%Y-%m-%d %H:%M:%S') for snapshot in snapshots],
-        "Num Threads": [snapshot.num_threads for snapshot in snapshots],
-        "Num Processes": [snapshot.num_processes for snapshot in snapshots],
-        "RAM Usage (MB)": [snapshot.ram_usage_mb for snapshot in snapshots],
+        "ID": ids,
+        "Device Name": device_names,
+        "Timestamp": [time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp)) for timestamp in timestamps],
+        "Num Threads": num_threads,
+        "Num Processes": num_processes,
+        "RAM Usage (MB)": ram_usage_mb,
     }
 
     return dcc.Graph(
@@ -420,46 +808,37 @@ def update_table(_):
 )
 def update_line_graph(selected_metric, device_name):
     if not device_name or not selected_metric:
-        return go.Figure()
-    
-    #Handle ESP32 temperature metrics
-    if selected_metric == 'temperature':
-        snapshots = ESP32TemperatureSnapshot.query \
-            .filter_by(device_name=device_name) \
-            .order_by(ESP32TemperatureSnapshot.timestamp.asc()) \
-            .all()
-    else:    
-        snapshots = DevicePerformanceSnapshot.query \
-            .filter_by(device_name=device_name) \
-            .order_by(DevicePerformanceSnapshot.timestamp.asc()) \
-            .all()
-
-    if not snapshots:
-        return go.Figure()
+        return EMPTY_FIGURE
+    return get_line_graph_figure(device_name, selected_metric)
+
+# Build the line graph figure, cached as a plain dict like the gauge
+@cache.memoize()
+def get_line_graph_figure(device_name, selected_metric):
+    timestamps, values = get_metric_history(device_name, selected_metric)
+    if not timestamps:
+        return EMPTY_FIGURE
     
     if selected_metric == 'temperature':
-        timestamps = [snapshot.timestamp for snapshot in snapshots]
-        values = [snapshot.temperature for snapshot in snapshots]
         metric_title = "ESP32 Temperature"
     else:
-        timestamps = [snapshot.timestamp for snapshot in snapshots]
-        values = [getattr(snapshot, selected_metric) for snapshot in snapshots]
         metric_title = selected_metric.replace('_', ' ').title()
 
     figure = go.Figure(
-        data=go.Scatter(x=timestamps, y=values, mode='lines+markers', name=selected_metric),
+        # Plotly reads numbers on a date axis as milliseconds since the epoch
+        data=go.Scatter(x=[timestamp * 1000 for timestamp in timestamps], y=values, mode='lines+markers', name=selected_metric),
         layout=go.Layout(
             title=f"{metric_title} Over Time for {device_name}",
-            xaxis=dict(title="Time"),
+            xaxis=dict(title="Time", type='date'),
             yaxis=dict(title=selected_metric.replace('_', ' ').title()),
         )
     )
 
-    return figure
+    return figure.to_plotly_json()
 
+# Local development only, in production the app is served by gunicorn through wsgi.py
 if __name__ == '__main__':
     server_config = config['server']
-    logger.info(f"Starting server on {server_config['host']}:{server_config['port']}")
-    app.run(debug=True, host=server_config['host'], port=server_config['port'])
+    logger.info('Starting server on %s:%s', server_config['host'], server_config['port'])
+    app.run(host=server_config['host'], port=server_config['port'])
 
 
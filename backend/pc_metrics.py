@@ -1,49 +1,153 @@
 # description: This script collects system performance metrics and saves them to a file in a queue directory.
 # The script is designed to run continuously and collect metrics at regular intervals.
 # The metrics are saved in JSON format with the device name, number of threads, number of processes, RAM usage, and timestamp.
+# Records are buffered in memory and a background thread appends them in batches, one line each, to hourly segment files.
 # The script logs the collected metrics and any errors that occur during processing.
 # The script can be run as a standalone program and will collect metrics at the specified interval.
 
 import os
+import threading
+import collections
+import sys
 import time
 import logging
 from logging.handlers import RotatingFileHandler
-import yaml
+from config_loader import load_yaml_cached
+from log_handlers import BatchedMemoryHandler, start_queue_logging
+from queue_files import ensure_dir, hour_bounds, segment_path
 import psutil
-import platform
 import socket
-import json
+import orjson
+
+# Skip collecting thread and process details for log records, they are never formatted
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
+# Maximum number of records waiting to be written, the oldest are dropped beyond this.
+# Kept below the kernel's IOV_MAX (1024 on Linux) so a full batch fits in one writev call
+PENDING_RECORDS_MAX = 1000
+# Write once this many records are waiting, or after the interval, whichever comes first
+WRITE_BATCH_SIZE = 16
+WRITE_INTERVAL_SECONDS = 10
+
+# Multiplier to convert bytes to MB
+BYTES_TO_MB = 1.0 / (1024 * 1024)
+
+def _meminfo_kb(meminfo, key):
+    # Parse the value in kB following a key in /proc/meminfo
+    start = meminfo.find(key)
+    if start < 0:
+        return 0
+    end = meminfo.find(b'\n', start + len(key))
+    return int(meminfo[start + len(key):end].split()[0])
+
+def _linux_count_threads():
+    # Read the Threads: line from /proc/<pid>/status directly, skipping psutil's per-process overhead
+    total_threads = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/status', 'rb') as f:
+                status = f.read()
+        except OSError:
+            # Process exited between listing and reading
+            continue
+        _, found, rest = status.partition(b'\nThreads:\t')
+        if found:
+            total_threads += int(rest.partition(b'\n')[0])
+    return total_threads
+
+def _linux_count_tasks(loadavg_fd):
+    # The kernel's count of scheduling entities, i.e. every thread on the system, is the
+    # denominator of the fourth /proc/loadavg field ("runnable/total"). It is host wide even
+    # inside a container, unlike the /proc scans which only see this PID namespace
+    loadavg = os.pread(loadavg_fd, 128, 0)
+    return int(loadavg.split()[3].partition(b'/')[2])
+
+def _linux_count_processes():
+    # Count the numeric /proc entries without building a list of pids
+    with os.scandir('/proc') as entries:
+        return sum(1 for entry in entries if entry.name[0].isdigit())
+
+def _linux_ram_used_bytes(meminfo_fd):
+    # RAM in use, calculated the same way as psutil.virtual_memory().used
+    meminfo = os.pread(meminfo_fd, 4096, 0)
+    used = _meminfo_kb(meminfo, b'MemTotal:') - _meminfo_kb(meminfo, b'\nMemAvailable:')
+    return used * 1024
+
+def _psutil_count_threads_and_processes():
+    # One walk over the process table for both counts, process_iter fetches num_threads with oneshot
+    total_threads = 0
+    total_processes = 0
+    for proc in psutil.process_iter(['num_threads']):
+        total_processes += 1
+        # None when the process exited or access was denied
+        total_threads += proc.info['num_threads'] or 0
+    return total_threads, total_processes
 
 class MetricsClient:
     def __init__(self, config_path='config.yaml', queue_dir='metrics_queue'):
         # Load configuration
-        with open(config_path, 'r') as file:
-            self.config = yaml.safe_load(file)
+        self.config = load_yaml_cached(config_path)
         
         # Setup logging
         self.logger = self._setup_logging()
         
         # Create queue directory if it doesn't exist
         self.queue_dir = queue_dir
-        os.makedirs(self.queue_dir, exist_ok=True)
+        ensure_dir(self.queue_dir)
         
         # Client configuration
         self.client_config = self.config['client']
 
+        # Generate device name with prefix from config, the host name doesn't change while running
+        self._device_name = f"{self.client_config['device_name_prefix']}-{socket.gethostname()}"
+
+        # /proc files the collector keeps open between samples, closed by close()
+        self._proc_fds = []
+
+        # Pick the metrics collector for this platform once, rather than on every sample
+        if sys.platform.startswith('linux'):
+            self._collect = self._make_linux_collector()
+        else:
+            self._collect = self._make_fallback_collector()
+
+        # Records waiting to be written, as (timestamp, JSON line) pairs
+        self._pending = collections.deque(maxlen=PENDING_RECORDS_MAX)
+        self._pending_ready = threading.Event()
+        self._closed = False
+        # Open segment file descriptor and the hour it covers
+        self._segment_fd = None
+        self._segment_hour = None
+        # Segment paths are this prefix followed by the hour
+        self._segment_prefix = os.path.join(self.queue_dir, 'pc_metrics_')
+
+        # Background thread that writes pending records, so sampling never waits on disk I/O
+        self._writer = threading.Thread(target=self._write_pending_loop, name='metrics-writer', daemon=True)
+        self._writer.start()
+
     def _setup_logging(self):
         # Create logs directory if it doesn't exist
         log_dir = 'logs'
-        os.makedirs(log_dir, exist_ok=True)
+        ensure_dir(log_dir)
 
         # Create logger 
         logger = logging.getLogger('metrics_client')
+        # Already configured, adding handlers again would log every record twice
+        if logger.handlers:
+            return logger
         logger.setLevel(getattr(logging, self.config['logging']['level'].upper()))
 
+        # Handlers are run by the queue listener rather than attached to the logger
+        handlers = []
+
         # Console handler
         if self.config['logging']['console']['enabled']:
             console_handler = logging.StreamHandler()
             console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-            logger.addHandler(console_handler)
+            handlers.append(console_handler)
 
         # File handler
         if self.config['logging']['file']['enabled']:
@@ -53,10 +157,77 @@ class MetricsClient:
                 backupCount=5
             )
             file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-            logger.addHandler(file_handler)
+            # Debug records never reach the disk
+            file_handler.setLevel(logging.INFO)
+            # Write the file in batches of up to 100 records, errors are written straight away
+            handlers.append(BatchedMemoryHandler(100, logging.ERROR, file_handler))
+
+        # Hand records to a background thread so the caller never waits on log I/O
+        start_queue_logging(logger, handlers)
 
         return logger
 
+    def _make_linux_collector(self):
+        """
+        Build a metrics collector bound to the Linux /proc fast paths
+        
+        Returns:
+        function: Collector returning a dictionary of system performance metrics
+        """
+        # Bind everything the collector needs as closure variables, so each sample skips
+        # platform checks and attribute lookups
+        device_name = self._device_name
+        count_processes = _linux_count_processes
+        ram_used_bytes = _linux_ram_used_bytes
+        now = time.time
+
+        # Keep /proc/meminfo open so each sample is a single pread
+        meminfo_fd = os.open('/proc/meminfo', os.O_RDONLY)
+        self._proc_fds.append(meminfo_fd)
+
+        # Read the kernel's thread count in constant time, or sum every process's thread count.
+        # Off by default since the kernel's count isn't scoped like the process count
+        if self.client_config.get('kernel_thread_count', False):
+            loadavg_fd = os.open('/proc/loadavg', os.O_RDONLY)
+            self._proc_fds.append(loadavg_fd)
+
+            def count_threads():
+                return _linux_count_tasks(loadavg_fd)
+        else:
+            count_threads = _linux_count_threads
+
+        def collect():
+            return {
+                'device_name': device_name,
+                'num_threads': count_threads(),
+                'num_processes': count_processes(),
+                'ram_usage_mb': ram_used_bytes(meminfo_fd) * BYTES_TO_MB,  # Convert to MB
+                'timestamp': int(now())
+            }
+
+        return collect
+
+    def _make_fallback_collector(self):
+        """
+        Build a metrics collector using psutil, for platforms without /proc
+        
+        Returns:
+        function: Collector returning a dictionary of system performance metrics
+        """
+        device_name = self._device_name
+
+        def collect():
+            num_threads, num_processes = _psutil_count_threads_and_processes()
+            return {
+                'device_name': device_name,
+                'num_threads': num_threads,
+                'num_processes': num_processes,
+                'ram_usage_mb': psutil.virtual_memory().used * BYTES_TO_MB,  # Convert to MB
+                'timestamp': int(time.time())
+            }
+
+        return collect
+
     def get_system_metrics(self):
         """
         Collect system performance metrics
@@ -65,48 +236,113 @@ class MetricsClient:
         dict: A dictionary containing system performance metrics
         """
         try:
-            # Generate device name with prefix from config
-            device_name = f"{self.client_config['device_name_prefix']}-{platform.node()}-{socket.gethostname()}"
-            
-            # Total number of threads
-            total_threads = sum(proc.num_threads() for proc in psutil.process_iter(attrs=['num_threads']))
+            metrics = self._collect()
             
-            metrics = {
-                'device_name': device_name,
-                'num_threads': total_threads,
-                'num_processes': len(psutil.pids()),
-                'ram_usage_mb': psutil.virtual_memory().used / (1024 * 1024),  # Convert to MB
-                'timestamp': int(time.time())
-            }
-            
-            self.logger.debug(f"Collected metrics: {metrics}")
+            self.logger.debug("Collected metrics: %s", metrics)
             return metrics
         except Exception as e:
-            self.logger.error(f"Error collecting system metrics: {e}")
+            self.logger.error("Error collecting system metrics: %s", e)
             return None
 
     def save_metrics(self, metrics):
         """
-        Save metrics to a file in the queue directory
+        Queue metrics to be appended to the current hourly segment in the queue directory
         
         Args:
         metrics (dict): System performance metrics
         """
         if metrics:
             try:
-                # Create a unique filename with timestamp
-                filename = os.path.join(
-                    self.queue_dir, 
-                    f"pc_metrics_{int(time.time())}.json"
-                )
-                
-                # Write metrics to file
-                with open(filename, 'w') as f:
-                    json.dump(metrics, f)
-                
-                self.logger.info(f"Saved metrics to {filename}")
+                # Serialize now so the writer only handles bytes
+                line = orjson.dumps(metrics, option=orjson.OPT_APPEND_NEWLINE)
+                self._pending.append((metrics['timestamp'], line))
+
+                # Wake the writer early once a full batch is waiting
+                if len(self._pending) >= WRITE_BATCH_SIZE:
+                    self._pending_ready.set()
+
+                self.logger.debug("Queued metrics for writing")
             except Exception as e:
-                self.logger.error(f"Error saving metrics: {e}")
+                self.logger.error("Error saving metrics: %s", e)
+
+    def _write_pending_loop(self):
+        # Write pending records every interval, or sooner when woken by save_metrics or close
+        while not self._closed:
+            self._pending_ready.wait(WRITE_INTERVAL_SECONDS)
+            self._pending_ready.clear()
+            self._write_pending()
+        # Write whatever arrived before closing
+        self._write_pending()
+
+    def _write_pending(self):
+        """
+        Append every pending record to its hourly segment file
+        """
+        batch = []
+        while self._pending:
+            batch.append(self._pending.popleft())
+        if not batch:
+            return
+
+        try:
+            # Records arrive in time order, so split the batch wherever the hour changes.
+            # The hour is only formatted again once a record passes the end of the current one
+            hour = None
+            hour_end = None
+            lines = []
+            for timestamp, line in batch:
+                if hour_end is None or timestamp >= hour_end:
+                    record_hour, hour_end = hour_bounds(timestamp)
+                    if record_hour != hour and lines:
+                        self._write_segment(hour, lines)
+                        lines = []
+                    hour = record_hour
+                lines.append(line)
+            self._write_segment(hour, lines)
+        except Exception as e:
+            self.logger.error("Error writing %d metrics records: %s", len(batch), e)
+
+    def _write_segment(self, hour, lines):
+        """
+        Append lines to the segment file for an hour with a single write
+        
+        Args:
+        hour (str): Hour the segment covers, formatted as YYYYMMDDHH
+        lines (list): Encoded JSON lines to append
+        """
+        # Roll over to a new segment when the hour changes
+        if hour != self._segment_hour:
+            if self._segment_fd is not None:
+                os.close(self._segment_fd)
+                self._segment_fd = None
+            filename = segment_path(self._segment_prefix, hour)
+            self._segment_fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._segment_hour = hour
+
+        # Gather every line into one system call where the platform supports it
+        data_len = sum(len(line) for line in lines)
+        if hasattr(os, 'writev'):
+            written = os.writev(self._segment_fd, lines)
+        else:
+            written = 0
+        if written < data_len:
+            # Finish a short or unsupported vectored write with a plain one
+            os.write(self._segment_fd, b''.join(lines)[written:])
+
+        self.logger.info("Saved %d metrics records to %s", len(lines), os.path.basename(segment_path(self._segment_prefix, hour)))
+
+    def close(self):
+        """
+        Stop the writer thread after it has written every pending record, and close the open files
+        """
+        self._closed = True
+        self._pending_ready.set()
+        self._writer.join()
+        if self._segment_fd is not None:
+            os.close(self._segment_fd)
+            self._segment_fd = None
+        while self._proc_fds:
+            os.close(self._proc_fds.pop())
 
     def run(self):
         """
@@ -114,6 +350,9 @@ class MetricsClient:
         """
         self.logger.info("Starting metrics collection...")
         
+        interval = self.client_config['metrics_interval_seconds']
+        next_sample = time.monotonic()
+        
         try:
             while True:
                 # Collect system metrics
@@ -122,13 +361,21 @@ class MetricsClient:
                 # Save metrics to queue
                 self.save_metrics(metrics)
                 
-                # Wait for next interval
-                time.sleep(self.client_config['metrics_interval_seconds'])
+                # Wait for next interval, measured from the previous deadline so collection time doesn't add drift
+                next_sample += interval
+                delay = next_sample - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Fell behind, e.g. after the machine was suspended, start again from now rather than catching up
+                    next_sample = time.monotonic()
         
         except KeyboardInterrupt:
             self.logger.info("Metrics collection stopped by user.")
         except Exception as e:
-            self.logger.error(f"Unexpected error: {e}")
+            self.logger.error("Unexpected error: %s", e)
+        finally:
+            self.close()
 
 def main():
     client = MetricsClient()
@@ -0,0 +1,37 @@
+# Description: This module provides the helpers shared by the collectors and the uploader for files in the metrics queue directory.
+# Collectors append JSON lines records to hourly segment files named <prefix>YYYYMMDDHH.jsonl, after the local hour they cover.
+# The uploader reads the hour back out of a segment's name to tell when the segment is no longer written to.
+
+import os
+import time
+
+# Segment names end in the hour they cover followed by this extension
+SEGMENT_EXTENSION = '.jsonl'
+# Format of the hour in segment names
+HOUR_FORMAT = '%Y%m%d%H'
+_HOUR_LENGTH = len('YYYYMMDDHH')
+
+# Directories already created by this process, so repeated setup skips the mkdir syscall
+_CREATED_DIRS: set[str] = set()
+
+def ensure_dir(path: str) -> None:
+    if path not in _CREATED_DIRS:
+        os.makedirs(path, exist_ok=True)
+        _CREATED_DIRS.add(path)
+
+def hour_bounds(timestamp: int) -> tuple[str, int]:
+    # Local hour a timestamp falls in, formatted as YYYYMMDDHH, and the time the next hour starts
+    local = time.localtime(timestamp)
+    return time.strftime(HOUR_FORMAT, local), timestamp - local.tm_min * 60 - local.tm_sec + 3600
+
+def current_hour() -> str:
+    # Local hour now, formatted as YYYYMMDDHH
+    return time.strftime(HOUR_FORMAT)
+
+def segment_path(prefix: str, hour: str) -> str:
+    # Path of the segment for an hour, the prefix includes the queue directory
+    return f"{prefix}{hour}{SEGMENT_EXTENSION}"
+
+def segment_hour(path: str) -> str:
+    # Hour a segment covers, formatted as YYYYMMDDHH, taken from the end of its name
+    return path[-_HOUR_LENGTH - len(SEGMENT_EXTENSION):-len(SEGMENT_EXTENSION)]
@@ -1,20 +1,95 @@
 # Description: This script reads metrics files from the queue directory and sends them to the server.
-# The script is designed to run continuously and process the queue at regular intervals.
+# The script is designed to run continuously and process the queue whenever files in it change, and at regular intervals.
+# On Linux changes are reported by inotify, elsewhere the queue is only processed at the interval.
 # The script reads metrics files from the queue directory, determines the endpoint based on the filename, and sends the metrics to the server.
+# Hourly JSON lines segments are uploaded incrementally, tracking progress in an offset file, and removed once their hour has passed.
 # The script logs the processing of each file and any errors that occur during processing.
 
 import os
+import sys
+import gzip
 import time
-import json
+import select
+import struct
+import ctypes
+from operator import attrgetter
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import requests
-import yaml
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config_loader import load_yaml_cached
+from log_handlers import BatchedMemoryHandler, start_queue_logging
+from queue_files import SEGMENT_EXTENSION, current_hour, segment_hour
+
+# Maximum number of uploads in flight at once
+UPLOAD_CONCURRENCY = 16
+# Maximum number of records sent in one request
+UPLOAD_BATCH_SIZE = 500
+# Batch bodies at least this large are sent gzip compressed, smaller ones aren't worth the CPU
+COMPRESS_MIN_BYTES = 1024
+# Time to let a burst of queue changes settle before uploading
+CHANGE_DEBOUNCE_SECONDS = 0.1
+
+# inotify flags and events, from <sys/inotify.h>. The flags are looked up since os only has them on
+# Unix, and inotify is only used on Linux
+IN_NONBLOCK = getattr(os, 'O_NONBLOCK', 0)
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+# Fixed part of each inotify event: wd, mask, cookie and the length of the name that follows
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+def _inotify_watch(path, mask):
+    """
+    Watch a directory with inotify
+    
+    Args:
+    path (str): Directory to watch
+    mask (int): Events to report
+    
+    Returns:
+    int: Non-blocking inotify file descriptor to read events from
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        errno = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(errno, f'inotify_add_watch failed for {path}')
+    return fd
+
+def _inotify_read_names(fd):
+    """
+    Read every pending inotify event
+    
+    Args:
+    fd (int): inotify file descriptor
+    
+    Returns:
+    list: Names of the files the events were for, empty names for events without one
+    """
+    names = []
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            return names
+        position = 0
+        while position < len(data):
+            _, _, _, length = _INOTIFY_EVENT.unpack_from(data, position)
+            position += _INOTIFY_EVENT.size
+            names.append(data[position:position + length].rstrip(b'\0'))
+            position += length
 
 class MetricsUploader:
     def __init__(self, config_path='config.yaml', queue_dir='metrics_queue'):
         # Load configuration
-        with open(config_path, 'r') as file:
-            self.config = yaml.safe_load(file)
+        self.config = load_yaml_cached(config_path)
         
         # Setup logging
         self.logger = self._setup_logging()
@@ -28,6 +103,16 @@ class MetricsUploader:
             'esp32': self.config['server']['esp32_metrics_endpoint']
         }
 
+        # Reuse one keep-alive connection to the server across uploads
+        self.session = self._setup_session()
+
+        # Threads that upload segments and file groups in parallel over the session's connection pool
+        self._executor = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY)
+
+        # Segment path -> [open file, upload offset], kept across queue passes so
+        # only the first pass over a segment opens it and reads its offset file
+        self._segments = {}
+
     def _setup_logging(self):
         # Create logs directory if it doesn't exist
         log_dir = 'logs'
@@ -35,64 +120,304 @@ class MetricsUploader:
 
         # Create logger
         logger = logging.getLogger('metrics_uploader')
+        # Already configured, adding handlers again would log every record twice
+        if logger.handlers:
+            return logger
         logger.setLevel(logging.INFO)
 
+        # Handlers are run by the queue listener rather than attached to the logger
+        handlers = []
+
         # Console handler
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-        logger.addHandler(console_handler)
+        handlers.append(console_handler)
 
         # File handler
         file_handler = logging.FileHandler(os.path.join(log_dir, 'uploader.log'))
         file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-        logger.addHandler(file_handler)
+        # Write the file in batches of up to 100 records, errors are written straight away
+        handlers.append(BatchedMemoryHandler(100, logging.ERROR, file_handler))
+
+        # Hand records to a background thread so the caller never waits on log I/O
+        start_queue_logging(logger, handlers)
 
         return logger
 
-    def send_metrics(self, file_path, endpoint):
+    def _setup_session(self):
+        client_config = self.config['client']
+
+        # Retry transient server errors with backoff
+        retries = Retry(
+            total=client_config['max_retry_attempts'],
+            backoff_factor=client_config['retry_delay_seconds'],
+            status_forcelist=[502, 503, 504],
+            allowed_methods=['POST'],
+            raise_on_status=False
+        )
+        # Both endpoints are normally on one host, keep a few spare host pools and enough
+        # connections per host for uploads running side by side
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+
+        session = requests.Session()
+        session.headers.update({'Content-Type': 'application/json', 'Accept': 'application/json'})
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
+
+    def _post_metrics(self, body, endpoint):
         """
-        Send metrics to the specified endpoint
+        Post a single metrics record to the specified endpoint
         
         Args:
-        file_path (str): Path to the metrics file
+        body (bytes): Metrics record, already serialized as JSON
         endpoint (str): URL to send metrics to
         
         Returns:
-        bool: True if successful, False otherwise
+        bool: True if the record was accepted or rejected as invalid, False if it should be retried
+        """
+        response = self.session.post(
+            endpoint, 
+            data=body, 
+            timeout=5  # 5-second timeout
+        )
+        
+        # Check response, the body is only read when something went wrong
+        if response.ok:
+            self.logger.debug("Server accepted metrics, %d byte response", len(response.content))
+            return True
+        elif response.status_code == 400:
+            # The server rejected the record itself, sending it again can't succeed so it is dropped
+            self.logger.error("Dropping metrics rejected by the server: %s", response.text[:256])
+            return True
+        else:
+            self.logger.error("Failed to upload metrics. Status code: %s, response: %s", response.status_code, response.text[:256])
+            return False
+
+    def _post_batch(self, records, endpoint):
+        """
+        Post several metrics records in one request to the endpoint's batch route
+        
+        Args:
+        records (list): Metrics records, each already serialized as JSON
+        endpoint (str): URL to send metrics to, the batch route is below it
+        
+        Returns:
+        int: Number of leading records that were accepted or rejected as invalid, the rest should be retried
         """
+        # Splice the stored records straight into the batch body rather than decoding them
+        body = b'{"snapshots":[' + b','.join(records) + b']}'
+        # Repeated keys make batches very compressible
+        headers = None
+        if len(body) >= COMPRESS_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=6)
+            headers = {'Content-Encoding': 'gzip'}
+        response = self.session.post(
+            f"{endpoint}/batch", 
+            data=body, 
+            headers=headers,
+            timeout=5  # 5-second timeout
+        )
+        
+        if response.ok:
+            return len(records)
+        elif response.status_code in (400, 404, 405):
+            # Either a record in the batch is invalid or the server has no batch route or can't
+            # read compressed bodies, post the records one by one so only invalid records are dropped
+            self.logger.warning("Batch upload rejected with status code %s, sending %d metrics individually", response.status_code, len(records))
+            # Only the records before the first failure count as sent, so none are skipped on the retry
+            sent = 0
+            for record in records:
+                if not self._post_metrics(record, endpoint):
+                    break
+                sent += 1
+            return sent
+        else:
+            self.logger.error("Failed to upload metrics batch. Status code: %s, response: %s", response.status_code, response.text[:256])
+            return 0
+
+    def _send_batches(self, records, endpoint):
+        """
+        Post records in batches of UPLOAD_BATCH_SIZE, one batch at a time
+        
+        Args:
+        records (list): Metrics records, each already serialized as JSON
+        endpoint (str): URL to send metrics to
+        
+        Returns:
+        generator: (batch, sent) pairs in record order, sent counts the leading records of the
+        batch that were uploaded. The next batch is only posted once the caller asks for it
+        """
+        for i in range(0, len(records), UPLOAD_BATCH_SIZE):
+            batch = records[i:i + UPLOAD_BATCH_SIZE]
+            yield batch, self._post_batch(batch, endpoint)
+
+    def send_metrics(self, file_paths, endpoint):
+        """
+        Send the metrics from single record files to the specified endpoint
+        
+        Args:
+        file_paths (list): Paths to the metrics files
+        endpoint (str): URL to send metrics to
+        
+        Returns:
+        list: Paths of the files that were uploaded
+        """
+        uploaded = []
         try:
-            # Read metrics from file
-            with open(file_path, 'r') as f:
-                metrics = json.load(f)
+            # Read metrics from the files, the JSON is sent exactly as it was saved
+            records = []
+            for file_path in file_paths:
+                with open(file_path, 'rb') as f:
+                    records.append(f.read().strip())
             
             # Send metrics
-            response = requests.post(
-                endpoint, 
-                json=metrics, 
-                headers={'Content-Type': 'application/json'},
-                timeout=5  # 10-second timeout
-            )
+            position = 0
+            for batch, sent in self._send_batches(records, endpoint):
+                uploaded.extend(file_paths[position:position + sent])
+                position += sent
+                # Stop at the first failure so records reach the server in the order they were saved
+                if sent < len(batch):
+                    break
             
-            # Check response
-            if response.status_code in [200, 201]:
-                self.logger.info(f"Successfully uploaded metrics from {file_path}")
-                return True
-            else:
-                self.logger.error(f"Failed to upload metrics. Status code: {response.status_code}")
-                return False
+            if uploaded:
+                self.logger.info("Successfully uploaded metrics from %d files", len(uploaded))
         
         except Exception as e:
-            self.logger.error(f"Error uploading metrics from {file_path}: {e}")
+            self.logger.error("Error uploading metrics files: %s", e)
+        return uploaded
+
+    def send_segment(self, file_path, endpoint):
+        """
+        Send the records appended to a JSON lines segment since the last upload
+        
+        Args:
+        file_path (str): Path to the segment file
+        endpoint (str): URL to send metrics to
+        
+        Returns:
+        bool: True if every complete record has been uploaded, False otherwise
+        """
+        # Upload progress is kept in a hidden offset file next to the segment
+        offset_path = os.path.join(self.queue_dir, f".{os.path.basename(file_path)}.offset")
+        segment = self._segments.get(file_path)
+        if segment is None:
+            segment = [open(file_path, 'rb'), self._read_offset(offset_path)]
+            self._segments[file_path] = segment
+        f, offset = segment
+        start = offset
+
+        try:
+            # Read everything appended since the last complete record
+            f.seek(offset)
+            data = f.read()
+            
+            # Only complete lines are uploaded, a partially written record is picked up next time
+            lines = data.split(b'\n')[:-1]
+            # Each line is already a JSON record, so it is posted without decoding it
+            for batch, sent in self._send_batches(lines, endpoint):
+                offset += sum(len(line) + 1 for line in batch[:sent])
+                # Stop at the first failure, later records are sent again on the next attempt
+                if sent < len(batch):
+                    return False
+            
+            if lines:
+                self.logger.info("Successfully uploaded %d metrics from %s", len(lines), file_path)
+            return True
+        
+        except Exception as e:
+            self.logger.error("Error uploading metrics from %s: %s", file_path, e)
+            return False
+        finally:
+            if offset != start:
+                segment[1] = offset
+                self._write_offset(offset_path, offset)
+
+    def _close_segment(self, file_path):
+        # Forget a segment that is about to be removed
+        segment = self._segments.pop(file_path, None)
+        if segment:
+            segment[0].close()
+
+    def _read_offset(self, offset_path):
+        try:
+            with open(offset_path, 'r') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def _write_offset(self, offset_path, offset):
+        # Write a temporary file and rename it over the old offset, so a crash mid-write never
+        # leaves a truncated offset that would restart the segment from the beginning
+        temp_path = f"{offset_path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(str(offset))
+        os.replace(temp_path, offset_path)
+
+    def _is_finished_segment(self, file_path):
+        """
+        Check whether a segment belongs to a past hour and is no longer written to
+        
+        Args:
+        file_path (str): Path to the segment file
+        
+        Returns:
+        bool: True if the segment can be removed once uploaded
+        """
+        # Segments are named after the hour they cover
+        if segment_hour(file_path) == current_hour():
             return False
+        
+        # Give the producer a grace period to finish its last write at the hour boundary
+        return time.time() - os.path.getmtime(file_path) > 60
+
+    def _upload_segment(self, file_path, endpoint):
+        """
+        Upload new records from a segment and remove it once its hour has passed
+        
+        Args:
+        file_path (str): Path to the segment file
+        endpoint (str): URL to send metrics to
+        """
+        if self.send_segment(file_path, endpoint) and self._is_finished_segment(file_path):
+            self._close_segment(file_path)
+            os.remove(file_path)
+            try:
+                os.remove(os.path.join(self.queue_dir, f".{os.path.basename(file_path)}.offset"))
+            except FileNotFoundError:
+                pass
+
+    def _upload_files(self, file_paths, endpoint):
+        """
+        Upload single record files and remove the ones that were uploaded
+        
+        Args:
+        file_paths (list): Paths to the metrics files
+        endpoint (str): URL to send metrics to
+        """
+        for file_path in self.send_metrics(file_paths, endpoint):
+            os.remove(file_path)
 
     def process_queue(self):
         """
         Process metrics files in the queue directory
         """
         try:
+            # Single record files are uploaded together per endpoint
+            pending_files = {}
+            # Uploads that can run side by side, each one keeps its own records in order
+            uploads = []
+
+            # Read the queue directory in one pass, skipping upload offset files. Names end in
+            # the hour or time they were written, so sorting the few that remain uploads oldest first
+            with os.scandir(self.queue_dir) as entries:
+                queued = sorted((entry for entry in entries if not entry.name.startswith('.')), key=attrgetter('name'))
+            
             # Iterate through files in queue directory
-            for filename in sorted(os.listdir(self.queue_dir)):
-                file_path = os.path.join(self.queue_dir, filename)
+            for entry in queued:
+                filename = entry.name
+                file_path = entry.path
                 
                 # Determine endpoint based on filename
                 if 'pc_metrics' in filename:
@@ -100,38 +425,93 @@ class MetricsUploader:
                 elif 'esp32_metrics' in filename:
                     endpoint = self.server_endpoints['esp32']
                 else:
-                    self.logger.warning(f"Unrecognized metrics file: {filename}")
+                    self.logger.warning("Unrecognized metrics file: %s", filename)
                     continue
                 
-                # Attempt to send metrics
-                if self.send_metrics(file_path, endpoint):
-                    # Remove file if successfully uploaded
-                    os.remove(file_path)
+                if filename.endswith(SEGMENT_EXTENSION):
+                    uploads.append(self._executor.submit(self._upload_segment, file_path, endpoint))
+                else:
+                    pending_files.setdefault(endpoint, []).append(file_path)
+            
+            for endpoint, file_paths in pending_files.items():
+                uploads.append(self._executor.submit(self._upload_files, file_paths, endpoint))
+
+            # Wait for every upload, so the next pass never reads a segment that is still being sent
+            for upload in uploads:
+                try:
+                    upload.result()
+                except Exception as e:
+                    self.logger.error("Error processing queue: %s", e)
         
         except Exception as e:
-            self.logger.error(f"Error processing queue: {e}")
+            self.logger.error("Error processing queue: %s", e)
+
+    def _watch_queue(self):
+        """
+        Start watching the queue directory for new and appended metrics files
+        
+        Returns:
+        int: inotify file descriptor, or None when changes can't be watched
+        """
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            os.makedirs(self.queue_dir, exist_ok=True)
+            return _inotify_watch(self.queue_dir, IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO)
+        except (OSError, AttributeError) as e:
+            self.logger.warning("Can't watch %s for changes, falling back to polling: %s", self.queue_dir, e)
+            return None
+
+    def _wait_for_changes(self, watch_fd, timeout):
+        """
+        Wait until a metrics file in the queue changes, or the timeout passes
+        
+        Args:
+        watch_fd (int): inotify file descriptor from _watch_queue
+        timeout (float): Longest time to wait (in seconds)
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([watch_fd], [], [], remaining)[0]:
+                return
+            # The uploader's own offset files are hidden, changes to them don't need an upload.
+            # Events without a name, such as a queue overflow, might hide a change so they count
+            if any(not name.startswith(b'.') for name in _inotify_read_names(watch_fd)):
+                break
+
+        # Let the rest of a burst of writes arrive, then discard their events
+        time.sleep(CHANGE_DEBOUNCE_SECONDS)
+        _inotify_read_names(watch_fd)
 
     def run(self, interval=20):
         """
         Continuously process the metrics queue
         
         Args:
-        interval (int): Time between queue processing attempts (in seconds)
+        interval (int): Longest time between queue processing attempts (in seconds)
         """
         self.logger.info("Starting metrics uploader...")
+        watch_fd = self._watch_queue()
         
         try:
             while True:
                 # Process metrics queue
                 self.process_queue()
                 
-                # Wait before next processing
-                time.sleep(interval)
+                # Wait for the queue to change, still processing it at the interval to retry failed uploads
+                if watch_fd is None:
+                    time.sleep(interval)
+                else:
+                    self._wait_for_changes(watch_fd, interval)
         
         except KeyboardInterrupt:
             self.logger.info("Metrics uploader stopped by user.")
         except Exception as e:
-            self.logger.error(f"Unexpected error: {e}")
+            self.logger.error("Unexpected error: %s", e)
+        finally:
+            if watch_fd is not None:
+                os.close(watch_fd)
 
 def main():
     uploader = MetricsUploader()
@@ -0,0 +1,4 @@
+# Description: WSGI entry point for running the Metrics server under a production server such as gunicorn.
+# Example: gunicorn wsgi:app (settings are read from gunicorn.conf.py)
+
+from main import app